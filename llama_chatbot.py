@@ -7,15 +7,38 @@ My hardware: Intel i3-1215U, 8GB DDR4 RAM, Intel UHD Graphics
 import os
 import sys
 import json
+import codecs
+import hashlib
+import ctypes
+import ctypes.util
+import functools
 from datetime import datetime
 from zoneinfo import ZoneInfo
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import Any, List, Dict, Optional
+import numpy as np
+import llama_cpp
 from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from numba import njit
+except ImportError:
+    # Same results, just a slower Python-level n-gram search
+    def njit(*args, **kwargs):
+        return lambda func: func
 
 # Configuration
 MODEL_PATH = "models/Llama-3.1-8B-Instruct-Q4_K_M.gguf"
 CHAT_HISTORY_DIR = "chat_history"
+SESSION_STATE_FILE = "_session_sysprompt.bin"   # System-prompt KV cache, in CHAT_HISTORY_DIR
+STATE_SUFFIX = ".state"                         # KV cache saved next to each chat JSON
+STATE_KEY_SUFFIX = ".key"                       # Setup fingerprint next to each state file
 SYSTEM_PROMPT = """You are a warm, friendly, and highly intelligent AI assistant. You communicate naturally and conversationally, like a knowledgeable friend who genuinely wants to help. 
 
 Be clear and direct in your responses, but keep your tone approachable and engaging. Provide detailed explanations when needed, but do it in a way that feels natural, not overly formal. Use structure (like bullet points or numbered lists) only when it genuinely makes things clearer - otherwise, just talk normally.
@@ -29,14 +52,17 @@ MODEL_CONFIG = {
     "model_path": MODEL_PATH,
     "n_ctx": 24576,             # Increased context - uses ~6.5GB RAM total
     "n_batch": 512,             # Optimal batch size for CPU
-    "n_ubatch": 256,            # Physical batch size
-    "n_threads": 7,             # Max threads for i3-1215U (6P+4E cores)
-    "n_threads_batch": 7,       # Threads for batch processing
-    "n_gpu_layers": 33,          # CPU-only (change to 33 for GPU)
+    "n_ubatch": 512,            # Physical batch size; override with LLAMA_UBATCH
+    "n_threads": 2,             # Physical P-cores on i3-1215U (2P+4E cores)
+    "n_threads_batch": 2,       # Replaced by detected P-core count at load
+    "n_gpu_layers": 33,         # All layers on the iGPU (needs a SYCL/Vulkan build)
     "main_gpu": 0,
-    "use_mlock": False,         # Don't lock memory (can cause issues)
+    "offload_kqv": True,        # Keep the KV cache and attention on the iGPU
+    "use_mlock": False,         # Turned on at load if enough RAM is free
     "use_mmap": True,           # Memory map for efficiency
-    "f16_kv": True,             # FP16 key-value cache saves RAM
+    "type_k": 8,                # Q8_0 key cache - attention scores are precision-sensitive
+    "type_v": 2,                # Q4_0 value cache - tolerates coarser quantization
+    "flash_attn": True,         # Required by llama.cpp for a quantized V cache
     "logits_all": False,        # Only compute last token logits
     "vocab_only": False,
     "verbose": False,           # Clean output
@@ -44,28 +70,334 @@ MODEL_CONFIG = {
     "rope_freq_scale": 0.0,
 }
 
+# Pin the weights in RAM only when this much memory is available at load
+MLOCK_MIN_AVAILABLE_GB = 6
+MADV_HUGEPAGE = 14
+
+# Speculative decoding - off by default. A draft proposes NUM_DRAFT_TOKENS
+# per step and the 8B model verifies them in one batch. llama-cpp-python
+# then keeps logits for every position (n_ctx x 128k vocab floats), so
+# n_ctx is capped to SPECULATIVE_MAX_N_CTX while it is on.
+SPECULATIVE_DECODING = None     # "ngram" (prompt lookup) or "draft" (DRAFT_MODEL_PATH)
+NUM_DRAFT_TOKENS = 4
+NGRAM_DRAFT_TOKENS = 5
+NGRAM_MAX_SIZE = 3              # Longest suffix matched by the n-gram drafter
+SPECULATIVE_MAX_N_CTX = 4096    # ~2GB of logits instead of ~12.6GB at 24k
+DRAFT_MODEL_PATH = "models/Llama-3.2-1B-Instruct-Q4_K_M.gguf"
+DRAFT_MODEL_CONFIG = {
+    "model_path": DRAFT_MODEL_PATH,
+    "n_ctx": SPECULATIVE_MAX_N_CTX,
+    "n_batch": MODEL_CONFIG["n_batch"],
+    "n_threads": 2,
+    "n_threads_batch": 2,
+    "n_gpu_layers": 0,          # Small enough to run on the CPU
+    "type_k": 8,
+    "type_v": 8,
+    "flash_attn": True,
+    "verbose": False,
+}
+
+# KV cache types: name -> (ggml_type enum, bytes per element)
+KV_CACHE_TYPES = {
+    "f16": (1, 2.0),
+    "q8_0": (8, 34 / 32),
+    "q5_1": (7, 24 / 32),
+    "q4_0": (2, 18 / 32),
+    "iq4_nl": (20, 18 / 32),
+}
+
+# Set LLAMA_KV_CHECK=1 to measure the quantized cache against FP16 at load
+KV_CHECK_N_CTX = 512
+KV_CHECK_PROMPT = (f"<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n{SYSTEM_PROMPT}<|eot_id|>"
+                   "<|start_header_id|>user<|end_header_id|>\n\nHow does a CPU cache work?<|eot_id|>"
+                   "<|start_header_id|>assistant<|end_header_id|>\n\n")
+
+# Llama-3.1-8B attention shape, used for the KV cache estimate
+MODEL_N_LAYERS = 32
+MODEL_KV_DIM = 1024             # 8 KV heads x 128 head dim
+
 # Generation parameters - optimized for speed and quality
 GENERATION_CONFIG = {
-    "max_tokens": 2048,         # Max response length
-    "temperature": 0.8,         # Balanced creativity
+    "temp": 0.8,                # Balanced creativity
     "top_p": 0.92,              # Nucleus sampling
     "top_k": 40,                # Top-k sampling
     "repeat_penalty": 1.15,     # Reduce repetition
     "presence_penalty": 0.0,
     "frequency_penalty": 0.0,
-    "stop": ["<|eot_id|>"],     # Stop token
-    "stream": True,             # Stream for responsive feel
-    "echo": False
 }
+MAX_RESPONSE_TOKENS = 2048      # Max response length
+DETOKENIZE_EVERY = 4            # Tokens detokenized, written and flushed per chunk
+CONTEXT_EVICT_THRESHOLD = 0.85  # Drop oldest turns past this share of n_ctx...
+CONTEXT_EVICT_TARGET = 0.55     # ...down to this share, so re-prefills stay rare
+TOKEN_CACHE_SIZE = 1024        # Memoized token counts kept per session
+TRIM_HEAP_EVERY = 20           # Turns between malloc_trim calls
+MESSAGE_OVERHEAD_TOKENS = 5    # Header and <|eot_id|> tokens around each message
+PROMPT_OVERHEAD_TOKENS = 10     # <|begin_of_text|>, system header/<|eot_id|>, assistant header
+ASSISTANT_HEADER = b"<|start_header_id|>assistant<|end_header_id|>\n\n"
+
+
+def kv_cache_type_name(ggml_type: int) -> str:
+    """Map a ggml_type enum value back to its KV_CACHE_TYPES name"""
+    for name, (type_id, _) in KV_CACHE_TYPES.items():
+        if type_id == ggml_type:
+            return name
+    raise ValueError(f"Unsupported KV cache ggml_type: {ggml_type} "
+                     f"(choose from {', '.join(KV_CACHE_TYPES)})")
+
+
+def _parse_cpu_list(text: str) -> List[int]:
+    """Parse a sysfs CPU list such as '0-3,6' into CPU ids"""
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def performance_core_cpus() -> List[int]:
+    """Return one logical CPU per physical performance core
+    
+    On Intel hybrid chips (Alder Lake and later) the P-cores are listed in
+    /sys/devices/cpu_core/cpus; E-cores are skipped so the slowest core
+    doesn't gate every token. Hyperthread siblings are skipped so two
+    matmul threads never share one core's L1/L2.
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    
+    p_core_list = Path("/sys/devices/cpu_core/cpus")
+    if p_core_list.exists():
+        p_cores = set(_parse_cpu_list(p_core_list.read_text()))
+        cpus = [cpu for cpu in cpus if cpu in p_cores] or cpus
+    
+    seen_cores = set()
+    physical = []
+    for cpu in cpus:
+        topology = Path(f"/sys/devices/system/cpu/cpu{cpu}/topology")
+        try:
+            core = (topology / "physical_package_id").read_text().strip(), \
+                   (topology / "core_id").read_text().strip()
+        except OSError:
+            core = ("cpu", str(cpu))
+        if core not in seen_cores:
+            seen_cores.add(core)
+            physical.append(cpu)
+    
+    return physical
+
+
+def pin_to_performance_cores() -> Optional[int]:
+    """Pin this process to physical P-cores, returning the thread count
+    
+    Equivalent to launching with `taskset -c <cpus>`. Returns None where
+    CPU affinity isn't supported (e.g. macOS).
+    """
+    if not hasattr(os, "sched_setaffinity"):
+        return None
+    
+    try:
+        cpus = performance_core_cpus()
+        os.sched_setaffinity(0, cpus)
+        return len(cpus)
+    except OSError:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def _load_libc() -> Optional[ctypes.CDLL]:
+    """Load the C library, or None where it can't be found"""
+    name = ctypes.util.find_library("c")
+    if not name:
+        return None
+    try:
+        return ctypes.CDLL(name, use_errno=True)
+    except OSError:
+        return None
+
+
+def trim_heap():
+    """Hand freed heap pages back to the OS with malloc_trim (glibc only)
+    
+    glibc rarely shrinks its arenas by itself, so string and dict churn from
+    a long chat would otherwise keep competing with the mmap'd weights.
+    """
+    libc = _load_libc()
+    if libc is None:
+        return
+    try:
+        libc.malloc_trim(0)
+    except AttributeError:
+        pass  # Not glibc
+
+
+def available_memory_bytes() -> Optional[int]:
+    """Read MemAvailable from /proc/meminfo (Linux only)"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def memlock_limit_allows(n_bytes: int) -> bool:
+    """Check RLIMIT_MEMLOCK lets this process lock n_bytes
+    
+    Most distros cap unprivileged users at a few MB, and llama.cpp then
+    quietly carries on unlocked, so check before asking for use_mlock.
+    """
+    try:
+        import resource
+    except ImportError:
+        return False
+    soft, _ = resource.getrlimit(resource.RLIMIT_MEMLOCK)
+    return soft == resource.RLIM_INFINITY or soft >= n_bytes
+
+
+def advise_hugepages(path: str) -> int:
+    """madvise(MADV_HUGEPAGE) every mapping of path, returning bytes advised
+    
+    Lets the kernel back the mmap'd weights with 2MB pages, so the matmul
+    loop takes fewer TLB misses. Needs transparent huge pages set to
+    'madvise' or 'always'; otherwise it's a harmless no-op.
+    """
+    libc = _load_libc()
+    if libc is None:
+        return 0
+    libc.madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+    
+    real_path = os.path.realpath(path)
+    advised = 0
+    try:
+        with open("/proc/self/maps") as f:
+            for line in f:
+                fields = line.split(maxsplit=5)
+                if len(fields) < 6 or fields[5].strip() != real_path:
+                    continue
+                start, end = (int(addr, 16) for addr in fields[0].split("-"))
+                if libc.madvise(start, end - start, MADV_HUGEPAGE) == 0:
+                    advised += end - start
+    except OSError:
+        pass
+    return advised
+
+
+def kv_quant_kl(config: Dict[str, Any], prompt: str = KV_CHECK_PROMPT) -> float:
+    """KL divergence (nats) of the next-token distribution, FP16 vs quantized KV cache
+    
+    Runs the prompt through two short-context copies of the model, one at a
+    time, so the check costs a couple of small KV caches rather than two
+    full ones. The weights are mmap'd, so the second load is quick.
+    """
+    log_probs = []
+    for type_k, type_v in ((KV_CACHE_TYPES["f16"][0],) * 2, (config["type_k"], config["type_v"])):
+        check_config = dict(config, n_ctx=KV_CHECK_N_CTX, type_k=type_k, type_v=type_v,
+                            use_mlock=False, logits_all=False)
+        check_config.pop("draft_model", None)
+        llm = Llama(**check_config)
+        llm.eval(llm.tokenize(prompt.encode("utf-8"), add_bos=False, special=True))
+        # Read the last token's logits from the context itself; newer
+        # llama-cpp-python only fills Llama.scores when logits_all is set
+        logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(llm.ctx, -1),
+                                       shape=(llm.n_vocab(),)).astype(np.float64)
+        del llm
+        
+        logits -= logits.max()
+        log_probs.append(logits - np.log(np.exp(logits).sum()))
+    
+    p, q = log_probs
+    return float(np.sum(np.exp(p) * (p - q)))
+
+
+@njit(cache=True)
+def ngram_lookup(tokens: np.ndarray, ngram_size: int, max_draft: int) -> np.ndarray:
+    """Return the tokens that followed the latest earlier copy of the last n-gram"""
+    n = tokens.shape[0]
+    suffix_start = n - ngram_size
+    for i in range(suffix_start - 1, -1, -1):
+        match = True
+        for j in range(ngram_size):
+            if tokens[i + j] != tokens[suffix_start + j]:
+                match = False
+                break
+        if match:
+            end = min(i + ngram_size + max_draft, n)
+            return tokens[i + ngram_size:end].copy()
+    return tokens[:0].copy()
+
+
+class NgramDraftModel(LlamaDraftModel):
+    """Prompt-lookup drafts: copy what followed the current suffix earlier on"""
+    
+    def __init__(self, max_ngram_size: int = NGRAM_MAX_SIZE,
+                 num_pred_tokens: int = NGRAM_DRAFT_TOKENS):
+        self.max_ngram_size = max_ngram_size
+        self.num_pred_tokens = num_pred_tokens
+    
+    def __call__(self, input_ids: np.ndarray, /, **kwargs) -> np.ndarray:
+        tokens = np.ascontiguousarray(input_ids, dtype=np.int32)
+        for ngram_size in range(self.max_ngram_size, 0, -1):
+            if tokens.shape[0] <= ngram_size:
+                continue
+            draft = ngram_lookup(tokens, ngram_size, self.num_pred_tokens)
+            if draft.shape[0]:
+                return draft.astype(np.intc)
+        return np.empty(0, dtype=np.intc)
+
+
+class DraftModel(LlamaDraftModel):
+    """Greedy token proposals from a small Llama sharing the 8B's vocabulary"""
+    
+    def __init__(self, llm: Llama, num_pred_tokens: int = NUM_DRAFT_TOKENS):
+        self.llm = llm
+        self.num_pred_tokens = num_pred_tokens
+    
+    def __call__(self, input_ids: np.ndarray, /, **kwargs) -> np.ndarray:
+        draft: List[int] = []
+        # generate() reuses the draft's KV cache for the shared prefix
+        for token in self.llm.generate(input_ids.tolist(), top_k=1, temp=0.0):
+            draft.append(token)
+            if len(draft) >= self.num_pred_tokens:
+                break
+        return np.array(draft, dtype=np.intc)
 
 
 class ChatBot:
     """Optimized chatbot class"""
     
-    def __init__(self, timezone_name: str = "Europe/London"):
+    def __init__(self, timezone_name: str = "Europe/London",
+                 cache_type_k: Optional[str] = None, cache_type_v: Optional[str] = None,
+                 speculative: Optional[str] = SPECULATIVE_DECODING):
+        if speculative not in (None, "ngram", "draft"):
+            raise ValueError(f"Unknown speculative mode: {speculative} (choose ngram or draft)")
+        # Default to the cache types set in MODEL_CONFIG
+        cache_type_k = cache_type_k or kv_cache_type_name(MODEL_CONFIG["type_k"])
+        cache_type_v = cache_type_v or kv_cache_type_name(MODEL_CONFIG["type_v"])
+        for cache_type in (cache_type_k, cache_type_v):
+            if cache_type not in KV_CACHE_TYPES:
+                raise ValueError(f"Unknown KV cache type: {cache_type} "
+                                 f"(choose from {', '.join(KV_CACHE_TYPES)})")
+        self.cache_type_k = cache_type_k
+        self.cache_type_v = cache_type_v
+        self.speculative = speculative
         self.llm: Optional[Llama] = None
-        self.chat_history: List[Dict[str, str]] = []
+        self.n_ctx = MODEL_CONFIG["n_ctx"]
+        self.draft_llm: Optional[Llama] = None
+        self._stop_tokens: set = set()
+        self._sys_tokens = 0
+        self._tok_cache: Dict[int, int] = {}
+        self._turns = 0
+        self.chat_history: List[Dict[str, Any]] = []
+        self._window_start = 0          # First message still in the prompt
         self.system_prompt = SYSTEM_PROMPT
+        self._prompt_buf = bytearray()
+        self._rebuild_prompt_buf()
         self.current_chat_file: Optional[str] = None
         self.timezone = ZoneInfo(timezone_name)
         self._ensure_chat_dir()
@@ -80,24 +412,101 @@ class ChatBot:
         print("━" * 60)
         
         try:
+            config = dict(MODEL_CONFIG)
+            config["type_k"] = KV_CACHE_TYPES[self.cache_type_k][0]
+            config["type_v"] = KV_CACHE_TYPES[self.cache_type_v][0]
+            
+            # Bigger micro-batches reload the weights fewer times per prefill
+            # token; LLAMA_UBATCH=128/256/512 makes it easy to benchmark
+            ubatch = os.environ.get("LLAMA_UBATCH")
+            if ubatch:
+                try:
+                    n_ubatch = int(ubatch)
+                    if n_ubatch < 1:
+                        raise ValueError(ubatch)
+                    config["n_ubatch"] = min(n_ubatch, config["n_batch"])
+                except ValueError:
+                    print(f"⚠️  Ignoring invalid LLAMA_UBATCH: {ubatch}")
+            
+            # CPU-only builds silently ignore n_gpu_layers, so say so
+            if config["n_gpu_layers"] and not llama_cpp.llama_supports_gpu_offload():
+                print("⚠️  llama-cpp-python was built without GPU support - using CPU only")
+                print("💡 Rebuild with CMAKE_ARGS=\"-DGGML_VULKAN=ON\" to use the iGPU")
+                config["n_gpu_layers"] = 0
+            
+            # Lock the weights in RAM so the OS can't evict them mid-chat,
+            # but only when that won't starve everything else
+            mlock_hint = ""
+            available = available_memory_bytes()
+            if config["use_mmap"] and available and available > MLOCK_MIN_AVAILABLE_GB * 1024**3:
+                if memlock_limit_allows(os.path.getsize(MODEL_PATH)):
+                    config["use_mlock"] = True
+                else:
+                    mlock_hint = " (raise `ulimit -l` to allow)"
+            
+            # Pin before llama.cpp spawns its worker threads
+            n_threads = pin_to_performance_cores()
+            if n_threads:
+                config["n_threads"] = n_threads
+                config["n_threads_batch"] = n_threads
+            
+            if os.environ.get("LLAMA_KV_CHECK"):
+                print("🔬 Checking KV cache quantization... ", end="", flush=True)
+                kl = kv_quant_kl(config)
+                print(f"KL(f16 || {self.cache_type_k}/{self.cache_type_v}) = {kl:.5f} nats")
+            
+            if self.speculative == "ngram":
+                config["draft_model"] = NgramDraftModel()
+            elif self.speculative == "draft":
+                if Path(DRAFT_MODEL_PATH).exists():
+                    print("📦 Loading draft model... ", end="", flush=True)
+                    draft_n_ctx = min(config["n_ctx"], SPECULATIVE_MAX_N_CTX)
+                    self.draft_llm = Llama(**dict(DRAFT_MODEL_CONFIG, n_ctx=draft_n_ctx))
+                    config["draft_model"] = DraftModel(self.draft_llm)
+                    print("✓")
+                else:
+                    print(f"⚠️  Draft model not found: {DRAFT_MODEL_PATH} - speculative decoding off")
+            
+            if "draft_model" in config:
+                # Verifying drafts needs logits for every position, which
+                # llama-cpp-python allocates as n_ctx x vocab floats
+                config["logits_all"] = True
+                if config["n_ctx"] > SPECULATIVE_MAX_N_CTX:
+                    print(f"💡 Speculative decoding: context capped at {SPECULATIVE_MAX_N_CTX:,} tokens")
+                    config["n_ctx"] = SPECULATIVE_MAX_N_CTX
+            self.n_ctx = config["n_ctx"]
+            
             print("📦 Initializing... ", end="", flush=True)
-            self.llm = Llama(**MODEL_CONFIG)
+            self.llm = Llama(**config)
+            if config["use_mmap"]:
+                advise_hugepages(MODEL_PATH)
+            eot_id = self.llm.tokenize(b"<|eot_id|>", add_bos=False, special=True)[0]
+            self._stop_tokens = {self.llm.token_eos(), eot_id}
+            self._sys_tokens = self._count_tokens(self.system_prompt)
             print("✓")
             
+            print("🧠 Preparing system prompt... ", end="", flush=True)
+            print("✓ (restored)" if self._prefill_system_prompt() else "✓")
+            
             print("\n✅ Model loaded successfully!")
             print("━" * 60)
             
             # Calculate RAM usage
-            kv_cache_gb = (MODEL_CONFIG['n_ctx'] * 2 * 33) / (1024**3)
+            kv_bytes = KV_CACHE_TYPES[self.cache_type_k][1] + KV_CACHE_TYPES[self.cache_type_v][1]
+            kv_cache_gb = (self.n_ctx * MODEL_N_LAYERS * MODEL_KV_DIM * kv_bytes) / (1024**3)
             model_gb = 4.5 
             total_gb = kv_cache_gb + model_gb
             
-            print(f"📊 Context: {MODEL_CONFIG['n_ctx']:,} tokens | Threads: {MODEL_CONFIG['n_threads']}")
-            print(f"💾 KV Cache: ~{kv_cache_gb:.1f}GB | Model: ~{model_gb:.1f}GB | Total: ~{total_gb:.1f}GB")
-            print(f"⚡ GPU layers: {MODEL_CONFIG['n_gpu_layers']}")
+            print(f"📊 Context: {self.n_ctx:,} tokens | Threads: {config['n_threads']}")
+            print(f"💾 KV Cache ({self.cache_type_k}/{self.cache_type_v}): ~{kv_cache_gb:.1f}GB | Model: ~{model_gb:.1f}GB | Total: ~{total_gb:.1f}GB")
+            print(f"⚡ GPU layers: {config['n_gpu_layers']} | "
+                  f"Weights locked in RAM: {'yes' if config['use_mlock'] else 'no' + mlock_hint}")
+            if "draft_model" in config:
+                print(f"🎯 Speculative decoding: {self.speculative} "
+                      f"({config['draft_model'].num_pred_tokens} tokens/step)")
             
-            if MODEL_CONFIG['n_gpu_layers'] == 0:
-                print("💡 CPU-only mode (change n_gpu_layers to 33 for GPU)")
+            if config['n_gpu_layers'] == 0:
+                print("💡 CPU-only mode (set n_gpu_layers to 33 on a GPU build)")
             
             print("━" * 60)
             print("\n💬 Type your message or '/help' for commands\n")
@@ -112,16 +521,96 @@ class ChatBot:
             return False
     
     def format_chat_history(self) -> str:
-        """Format chat history in Llama 3.1 Instruct format"""
+        """Format the messages still in the context window in Llama 3.1 Instruct format"""
         formatted = f"<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n{self.system_prompt}<|eot_id|>"
         
-        for msg in self.chat_history:
+        for msg in self.chat_history[self._window_start:]:
             role = msg["role"]
             content = msg["content"]
             formatted += f"<|start_header_id|>{role}<|end_header_id|>\n\n{content}<|eot_id|>"
         
         return formatted
     
+    def _state_key(self) -> str:
+        """Fingerprint of everything a saved KV cache depends on"""
+        key = "|".join([llama_cpp.__version__, os.path.realpath(MODEL_PATH),
+                        str(self.n_ctx), self.cache_type_k, self.cache_type_v,
+                        self.system_prompt])
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+    
+    def _save_state(self, path: Path):
+        """Save the KV cache and evaluated tokens to path with llama.cpp
+        
+        Uses llama_state_save_file rather than Llama.save_state(), which
+        would also copy n_tokens x vocab floats of logits. A small sidecar
+        file records the setup the cache was made with.
+        """
+        n_tokens = self.llm.n_tokens
+        tokens = (llama_cpp.llama_token * n_tokens)(*self.llm.input_ids[:n_tokens].tolist())
+        if not llama_cpp.llama_state_save_file(self.llm.ctx, str(path).encode("utf-8"),
+                                               tokens, n_tokens):
+            raise OSError(f"llama.cpp couldn't write {path}")
+        path.with_name(path.name + STATE_KEY_SUFFIX).write_text(self._state_key())
+    
+    def _load_state(self, path: Path) -> bool:
+        """Restore the KV cache from path if it was saved with this setup"""
+        key_path = path.with_name(path.name + STATE_KEY_SUFFIX)
+        try:
+            if not path.exists() or key_path.read_text() != self._state_key():
+                return False
+        except OSError:
+            return False
+        
+        n_ctx = self.llm.n_ctx()
+        tokens = (llama_cpp.llama_token * n_ctx)()
+        n_loaded = ctypes.c_size_t(0)
+        if not llama_cpp.llama_state_load_file(self.llm.ctx, str(path).encode("utf-8"),
+                                               tokens, n_ctx, ctypes.byref(n_loaded)):
+            # Don't let generate() prefix-match against a half-loaded cache
+            self.llm.reset()
+            return False
+        
+        self.llm.input_ids[:n_loaded.value] = tokens[:n_loaded.value]
+        self.llm.n_tokens = n_loaded.value
+        return True
+    
+    def _prefill_system_prompt(self) -> bool:
+        """Load the system prompt's KV cache from disk, or compute and save it
+        
+        Returns True when the cache was restored. Either way the first turn
+        only prefills its own tokens; generate() matches the rest as a prefix.
+        """
+        path = Path(CHAT_HISTORY_DIR) / SESSION_STATE_FILE
+        if self._load_state(path):
+            return True
+        
+        self.llm.eval(self.llm.tokenize(bytes(self._prompt_buf), add_bos=False, special=True))
+        try:
+            self._save_state(path)
+        except Exception as e:
+            print(f"\n⚠️  Couldn't save session state: {e}")
+        return False
+    
+    def _count_tokens(self, text: str) -> int:
+        """Count tokens in text with the model's tokenizer, memoized by hash"""
+        key = hash(text)
+        n_tokens = self._tok_cache.get(key)
+        if n_tokens is None:
+            n_tokens = len(self.llm.tokenize(text.encode("utf-8"), add_bos=False))
+            if len(self._tok_cache) >= TOKEN_CACHE_SIZE:
+                del self._tok_cache[next(iter(self._tok_cache))]  # FIFO
+            self._tok_cache[key] = n_tokens
+        return n_tokens
+    
+    def _rebuild_prompt_buf(self):
+        """Re-render the running prompt from the full chat history"""
+        self._prompt_buf = bytearray(self.format_chat_history().encode("utf-8"))
+    
+    def _discard_turn(self, mark: int):
+        """Drop a failed user turn from history and the running prompt"""
+        self.chat_history.pop()
+        del self._prompt_buf[mark:]
+    
     def chat(self, user_input: str) -> Optional[str]:
         """Send a message and get response"""
         if not self.llm:
@@ -129,56 +618,110 @@ class ChatBot:
             return None
         
         # Add user message
-        self.chat_history.append({"role": "user", "content": user_input})
+        self.chat_history.append({"role": "user", "content": user_input,
+                                  "n_tokens": self._count_tokens(user_input)})
         
-        # Format prompt
-        prompt = self.format_chat_history()
-        prompt += "<|start_header_id|>assistant<|end_header_id|>\n\n"
+        # Append only the new turn; the unchanged prefix lets llama.cpp
+        # reuse its KV cache instead of re-running prefill
+        user_turn = f"<|start_header_id|>user<|end_header_id|>\n\n{user_input}<|eot_id|>".encode("utf-8")
+        mark = len(self._prompt_buf)
+        self._prompt_buf += user_turn + ASSISTANT_HEADER
+        
+        prompt_tokens = self.llm.tokenize(bytes(self._prompt_buf), add_bos=False, special=True)
+        
+        # Sliding window: once past the threshold, slide the window past the
+        # oldest (user, assistant) pairs down to the lower target. Dropping
+        # well below the threshold means the full re-prefill this forces
+        # happens every few dozen turns rather than every turn. The messages
+        # stay in chat_history, so saved chats keep the whole conversation.
+        if len(prompt_tokens) > self.n_ctx * CONTEXT_EVICT_THRESHOLD:
+            excess = len(prompt_tokens) - int(self.n_ctx * CONTEXT_EVICT_TARGET)
+            evicted = 0
+            while excess > 0 and self._window_start < len(self.chat_history) - 2:
+                for msg in self.chat_history[self._window_start:self._window_start + 2]:
+                    excess -= msg["n_tokens"] + MESSAGE_OVERHEAD_TOKENS
+                self._window_start += 2
+                evicted += 2
+            
+            if evicted:
+                self._rebuild_prompt_buf()
+                mark = len(self._prompt_buf) - len(user_turn)
+                self._prompt_buf += ASSISTANT_HEADER
+                prompt_tokens = self.llm.tokenize(bytes(self._prompt_buf), add_bos=False, special=True)
+                print(f"\n♻️  Context nearly full - {evicted} oldest messages left the context "
+                      f"(still kept in the saved chat)")
+        
+        max_tokens = min(MAX_RESPONSE_TOKENS, self.n_ctx - len(prompt_tokens))
+        if max_tokens <= 0:
+            print("❌ Context is full! Save and start a new chat")
+            self._discard_turn(mark)
+            return None
         
         # Generate response
         print("\n🤖 ", end="", flush=True)
-        response_text = ""
+        response_bytes = bytearray()
+        pending: List[int] = []
+        n_generated = 0
         
         try:
-            for output in self.llm(prompt, **GENERATION_CONFIG):
-                if "choices" in output and len(output["choices"]) > 0:
-                    choice = output["choices"][0]
-                    token = choice.get("text", "")
-                    
-                    if choice.get("finish_reason") == "stop":
-                        break
-                    
-                    if "<|eot_id|>" in token:
-                        token = token.replace("<|eot_id|>", "")
-                        if token:
-                            response_text += token
-                            print(token, end="", flush=True)
-                        break
-                    
-                    response_text += token
-                    print(token, end="", flush=True)
+            # Raw bytes straight to the terminal: one write and flush per chunk,
+            # no print() overhead, and UTF-8 split across chunks needs no care.
+            # Some IDE consoles have no byte buffer, so decode for those.
+            stdout_bytes = getattr(sys.stdout, "buffer", None)
+            if stdout_bytes is not None:
+                write = stdout_bytes.write
+            else:
+                decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+                write = lambda chunk: sys.stdout.write(decoder.decode(chunk))
+            flush = sys.stdout.flush
+            
+            for token in self.llm.generate(prompt_tokens, **GENERATION_CONFIG):
+                if token in self._stop_tokens:
+                    break
+                
+                pending.append(token)
+                n_generated += 1
+                
+                if len(pending) >= DETOKENIZE_EVERY:
+                    chunk = self.llm.detokenize(pending)
+                    pending.clear()
+                    response_bytes += chunk
+                    write(chunk)
+                    flush()
+                
+                if n_generated >= max_tokens:
+                    break
             
+            chunk = self.llm.detokenize(pending)
+            response_bytes += chunk
+            write(chunk)
             print()  # New line
             
-            response_text = response_text.strip()
+            response_text = response_bytes.decode("utf-8", errors="ignore").strip()
             
             if not response_text or len(response_text) < 2:
                 print("⚠️  No response generated.")
-                self.chat_history.pop()
+                self._discard_turn(mark)
                 return None
             
             # Add to history
-            self.chat_history.append({"role": "assistant", "content": response_text})
+            self.chat_history.append({"role": "assistant", "content": response_text,
+                                      "n_tokens": self._count_tokens(response_text)})
+            self._prompt_buf += f"{response_text}<|eot_id|>".encode("utf-8")
+            
+            self._turns += 1
+            if self._turns % TRIM_HEAP_EVERY == 0:
+                trim_heap()
             
             return response_text
             
         except KeyboardInterrupt:
             print("\n\n⚠️  Interrupted.")
-            self.chat_history.pop()
+            self._discard_turn(mark)
             return None
         except Exception as e:
             print(f"\n❌ Error: {e}")
-            self.chat_history.pop()
+            self._discard_turn(mark)
             return None
     
     def clear_chat(self):
@@ -190,13 +733,16 @@ class ChatBot:
         confirm = input("Clear chat? (y/n): ").strip().lower()
         if confirm == 'y':
             self.chat_history = []
+            self._window_start = 0
+            self._rebuild_prompt_buf()
             self.current_chat_file = None
+            trim_heap()
             print("✓ Chat cleared")
         else:
             print("✓ Cancelled")
     
-    def save_chat(self, custom_filename: Optional[str] = None):
-        """Save chat to JSON file"""
+    def save_chat(self, custom_filename: Optional[str] = None, save_state: bool = True):
+        """Save chat to JSON file, plus the model state unless save_state is False"""
         if not self.chat_history:
             print("⚠️  No chat to save!")
             return
@@ -221,18 +767,82 @@ class ChatBot:
         }
         
         try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(save_data, f, indent=2, ensure_ascii=False)
+            if orjson:
+                filepath.write_bytes(orjson.dumps(save_data, option=orjson.OPT_INDENT_2))
+            else:
+                with open(filepath, 'w', encoding='utf-8') as f:
+                    json.dump(save_data, f, indent=2, ensure_ascii=False)
             
             self.current_chat_file = filename
             print(f"✅ Chat saved: {filepath}")
         except Exception as e:
             print(f"❌ Error saving chat: {e}")
+            return
+        
+        # KV cache alongside, so /load can resume without re-running prefill.
+        # ~53KB per token at q8_0/q4_0, so up to ~1.2GB for a full context
+        if save_state and self.llm:
+            try:
+                self._save_state(filepath.with_suffix(STATE_SUFFIX))
+            except Exception as e:
+                print(f"⚠️  Couldn't save model state: {e}")
+        
+        trim_heap()
+    
+    def load_chat(self, filename: Optional[str]):
+        """Load a saved chat and, if available, its model state"""
+        if not filename:
+            print("❌ Usage: /load <name>")
+            return
+        
+        if self.chat_history:
+            confirm = input("Replace current chat? (y/n): ").strip().lower()
+            if confirm != 'y':
+                print("✓ Cancelled")
+                return
+        
+        filename = filename if filename.endswith('.json') else f"{filename}.json"
+        filepath = Path(CHAT_HISTORY_DIR) / filename
+        
+        try:
+            if orjson:
+                data = orjson.loads(filepath.read_bytes())
+            else:
+                with open(filepath, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            messages = data["messages"]
+            
+            for msg in messages:
+                if not (isinstance(msg.get("role"), str) and isinstance(msg.get("content"), str)):
+                    raise ValueError("message without role/content")
+                # Chats saved by older versions have no token counts
+                if "n_tokens" not in msg and self.llm:
+                    msg["n_tokens"] = self._count_tokens(msg["content"])
+        except FileNotFoundError:
+            print(f"❌ Chat not found: {filepath}")
+            return
+        except Exception as e:
+            print(f"❌ Error loading chat: {e}")
+            return
+        
+        self.chat_history = messages
+        self._window_start = 0
+        self.current_chat_file = filename
+        self._rebuild_prompt_buf()
+        
+        restored = self.llm is not None and self._load_state(filepath.with_suffix(STATE_SUFFIX))
+        print(f"✅ Chat loaded: {filepath} ({len(messages)} messages"
+              f"{', model state restored' if restored else ''})")
     
     def list_saved_chats(self) -> List[str]:
         """List all saved chats"""
-        chat_dir = Path(CHAT_HISTORY_DIR)
-        chat_files = sorted(chat_dir.glob("*.json"), key=lambda x: x.stat().st_mtime, reverse=True)
+        # DirEntry caches its stat() result, so each file is stat'ed once
+        try:
+            with os.scandir(CHAT_HISTORY_DIR) as it:
+                chat_files = [entry for entry in it if entry.name.endswith(".json") and entry.is_file()]
+        except FileNotFoundError:
+            chat_files = []
+        chat_files.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
         
         if not chat_files:
             print("📭 No saved chats found")
@@ -240,10 +850,11 @@ class ChatBot:
         
         print("\n💬 Saved chats:")
         print("=" * 70)
-        for i, filepath in enumerate(chat_files, 1):
-            mtime = datetime.fromtimestamp(filepath.stat().st_mtime, tz=self.timezone)
-            size_kb = filepath.stat().st_size / 1024
-            print(f"  {i}. {filepath.name}")
+        for i, entry in enumerate(chat_files, 1):
+            stat = entry.stat()
+            mtime = datetime.fromtimestamp(stat.st_mtime, tz=self.timezone)
+            size_kb = stat.st_size / 1024
+            print(f"  {i}. {entry.name}")
             print(f"     {mtime.strftime('%Y-%m-%d %H:%M:%S %Z')} | {size_kb:.1f} KB")
         print("=" * 70)
         
@@ -252,31 +863,37 @@ class ChatBot:
     def show_stats(self):
         """Show chat statistics"""
         total_messages = len(self.chat_history)
-        user_messages = sum(1 for msg in self.chat_history if msg["role"] == "user")
-        assistant_messages = sum(1 for msg in self.chat_history if msg["role"] == "assistant")
+        user_messages = assistant_messages = message_tokens = 0
+        for i, msg in enumerate(self.chat_history):
+            # Only messages inside the window are part of the prompt
+            if i >= self._window_start:
+                message_tokens += msg["n_tokens"] + MESSAGE_OVERHEAD_TOKENS
+            if msg["role"] == "user":
+                user_messages += 1
+            else:
+                assistant_messages += 1
         
-        # Estimate tokens
-        total_chars = sum(len(msg["content"]) for msg in self.chat_history)
-        estimated_tokens = total_chars // 4
-        system_tokens = len(self.system_prompt) // 4
-        total_estimated = estimated_tokens + system_tokens
+        # Count the prompt exactly as chat() sends it, template tokens included
+        total_tokens = message_tokens + self._sys_tokens + PROMPT_OVERHEAD_TOKENS
         
         print(f"\n📊 Chat Statistics:")
         print("=" * 50)
         print(f"  Total messages: {total_messages}")
         print(f"  User messages: {user_messages}")
         print(f"  Assistant messages: {assistant_messages}")
-        print(f"  Estimated tokens: ~{estimated_tokens:,}")
-        print(f"  With system prompt: ~{total_estimated:,}")
-        print(f"  Context limit: {MODEL_CONFIG['n_ctx']:,}")
+        if self._window_start:
+            print(f"  Out of context (still saved): {self._window_start}")
+        print(f"  Message tokens: {message_tokens:,}")
+        print(f"  With system prompt: {total_tokens:,}")
+        print(f"  Context limit: {self.n_ctx:,}")
         
-        if total_estimated > 0:
-            usage_pct = min(100, (total_estimated * 100) // MODEL_CONFIG['n_ctx'])
+        if total_tokens > 0:
+            usage_pct = min(100, (total_tokens * 100) // self.n_ctx)
             print(f"  Context usage: {usage_pct}%")
             
-            if usage_pct > 85:
+            if usage_pct > CONTEXT_EVICT_THRESHOLD * 100:
                 print(f"  ⚠️  Warning: Approaching context limit!")
-                print(f"     Save and start new chat soon")
+                print(f"     Oldest messages will leave the context on the next turn")
         
         if self.current_chat_file:
             print(f"  Current file: {self.current_chat_file}")
@@ -316,6 +933,7 @@ def print_help():
     print("  /help     - Show this message")
     print("  /clear    - Clear chat history")
     print("  /save     - Save conversation")
+    print("  /load     - Load a saved chat")
     print("  /list     - List saved chats")
     print("  /stats    - Show statistics")
     print("  /history  - Show chat history")
@@ -368,6 +986,9 @@ def main():
                     elif command == 'save':
                         bot.save_chat(args)
                     
+                    elif command == 'load':
+                        bot.load_chat(args)
+                    
                     elif command == 'list':
                         bot.list_saved_chats()
                     
@@ -405,7 +1026,7 @@ def main():
             print("\n" + "━" * 30)
             save = input("💾 Save chat? (y/n): ").strip().lower()
             if save == 'y':
-                bot.save_chat()
+                bot.save_chat(save_state=False)  # Skip the (large) KV state on exit
 
 
 if __name__ == "__main__":